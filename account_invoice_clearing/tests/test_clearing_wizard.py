@@ -1,6 +1,7 @@
 # Copyright 2023 Moduon Team S.L.
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl-3.0)
 
+import json
 from datetime import timedelta
 
 from odoo import fields
@@ -9,6 +10,8 @@ from odoo.tools import float_is_zero
 
 from odoo.addons.account.tests.common import AccountTestInvoicingCommon
 
+from ..wizards.account_invoice_clearing_wizard import _allocate_clearing_amount
+
 
 @tagged("post_install", "-at_install")
 class TestClearingWizard(AccountTestInvoicingCommon):
@@ -116,6 +119,77 @@ class TestClearingWizard(AccountTestInvoicingCommon):
                 self.assertEqual(cl_inv_1.payment_state, "paid")
                 self.assertEqual(cl_inv_2.payment_state, "paid")
 
+    def test_clearing_wizard_partial(self):
+        """Test partial clearing of several invoices keeps the allocation."""
+        t = fields.Date.today()
+        # Invoice A is dated later, so it is allocated first, but due later
+        inv_a = self.init_invoice(
+            invoice_date=t,
+            move_type="out_invoice",
+            partner=self.cl_partner,
+            amounts=[100],
+            post=False,
+        )
+        inv_b = self.init_invoice(
+            invoice_date=t - timedelta(days=1),
+            move_type="out_invoice",
+            partner=self.cl_partner,
+            amounts=[200],
+            post=False,
+        )
+        cl_bill = self.init_invoice(
+            invoice_date=t,
+            move_type="in_invoice",
+            partner=self.cl_partner,
+            amounts=[300],
+            post=False,
+        )
+        inv_a.invoice_date_due = t + timedelta(days=30)
+        inv_b.invoice_date_due = t + timedelta(days=10)
+        (inv_a | inv_b | cl_bill).action_post()
+        cw_action = (inv_a | inv_b).action_open_invoice_clearing_wizard()
+        wizard = self.env[cw_action["res_model"]].browse(cw_action["res_id"])
+        cl_line = wizard.line_ids.filtered(lambda line: line.invoice_id == cl_bill)
+        self.assertEqual(len(cl_line), 1)
+        cl_line.amount_to_clear = -150.0
+        wizard.invalidate_recordset()
+        wizard.button_confirm()
+        self.assertEqual(inv_a.payment_state, "paid")
+        self.assertAlmostEqual(inv_b.amount_residual, 150.0)
+        self.assertAlmostEqual(cl_bill.amount_residual, 150.0)
+
+    def test_clearing_wizard_move_data(self):
+        """Test moves data is not altered by the preview computation."""
+        t = fields.Date.today()
+        init_inv = self.init_invoice(
+            invoice_date=t,
+            move_type="out_invoice",
+            partner=self.cl_partner,
+            amounts=[100],
+            post=True,
+        )
+        self.init_invoice(
+            invoice_date=t,
+            move_type="in_invoice",
+            partner=self.cl_partner,
+            amounts=[100],
+            post=True,
+        )
+        cw_action = init_inv.action_open_invoice_clearing_wizard()
+        wizard = self.env[cw_action["res_model"]].browse(cw_action["res_id"])
+        wizard.action_fill_amount_to_clear()
+        wizard.invalidate_recordset()
+        move_data = json.loads(wizard.move_data)
+        preview_move_data = json.loads(wizard.preview_move_data)
+        self.assertTrue(move_data)
+        for move in move_data:
+            for line in move["line_ids"]:
+                self.assertIsInstance(line[2]["account_id"], int)
+        # Same data as the one used to create the moves, once serialized
+        expected = wizard.with_context(preview=True)._get_move_dict_vals()
+        self.assertEqual(json.loads(json.dumps(expected)), move_data)
+        self.assertEqual(len(preview_move_data["groups_vals"]), len(move_data))
+
     def test_account_types(self):
         aicw_model = self.env["account.invoice.clearing.wizard"]
         # For lines to clear
@@ -144,3 +218,20 @@ class TestClearingWizard(AccountTestInvoicingCommon):
                 "out_invoice", is_counterpart=True
             ),
         )
+
+    def test_allocate_clearing_amount(self):
+        """Test allocation of a residual amount over clearing lines."""
+        availability = {"cl_1": -50.0, "cl_2": -100.0, "cl_3": -30.0}
+        allocations = _allocate_clearing_amount(120.0, availability, 0.01)
+        self.assertEqual(
+            [("cl_1", 50.0, -1.0), ("cl_2", 70.0, -1.0)],
+            allocations,
+        )
+        # Fully used clearing lines are removed from availability
+        self.assertEqual({"cl_2": -30.0, "cl_3": -30.0}, availability)
+        allocations = _allocate_clearing_amount(100.0, availability, 0.01)
+        self.assertEqual(
+            [("cl_2", 30.0, -1.0), ("cl_3", 30.0, -1.0)],
+            allocations,
+        )
+        self.assertFalse(availability)
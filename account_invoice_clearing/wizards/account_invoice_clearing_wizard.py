@@ -6,7 +6,54 @@ from collections import OrderedDict
 from datetime import datetime
 
 from odoo import _, api, exceptions, fields, models
-from odoo.tools import float_is_zero, groupby
+from odoo.tools import float_is_zero, float_round, groupby
+
+
+def _get_clear_sign_modifier(a, b):
+    # Product is negative only when both amounts have a different sign
+    return -1.0 if a * b < 0.0 else 1.0
+
+
+def _get_amount_to_use(amount_to_fill, avaiable_amount, rounding):
+    amount = max(amount_to_fill, avaiable_amount)
+    if amount_to_fill > 0.0:
+        amount = min(amount_to_fill, avaiable_amount)
+    return float_round(amount, precision_rounding=rounding)
+
+
+def _allocate_clearing_amount(amount_residual, availability, rounding):
+    """Allocate a move line residual amount over the clearing lines.
+
+    ``availability`` maps every clearing line to its remaining amount to clear,
+    it is updated in place and fully used clearing lines are removed from it.
+    Return a list of ``(clearing_line, used_amount, clear_sign)`` tuples.
+    """
+    allocations, used_keys = [], []
+    for key, available_amount in availability.items():
+        # Move line fully cleared
+        if float_is_zero(amount_residual, precision_rounding=rounding):
+            break
+        # Clearing line fully used
+        if float_is_zero(available_amount, precision_rounding=rounding):
+            used_keys.append(key)
+            continue
+        # Choose correct sign to compute clearing amount
+        clear_sign = _get_clear_sign_modifier(amount_residual, available_amount)
+        # Used amount for clearing (sign aligned)
+        used_amount = _get_amount_to_use(
+            amount_residual, clear_sign * available_amount, rounding
+        )
+        # Remaining amount to clear on this move
+        amount_residual -= used_amount
+        # Remaining amount on this clearing move line
+        availability[key] = available_amount + used_amount
+        if float_is_zero(availability[key], precision_rounding=rounding):
+            used_keys.append(key)
+        allocations.append((key, used_amount, clear_sign))
+    # Fully used clearing lines are never visited again
+    for key in used_keys:
+        del availability[key]
+    return allocations
 
 
 class AccountInvoiceClearingWizard(models.TransientModel):
@@ -91,7 +138,7 @@ class AccountInvoiceClearingWizard(models.TransientModel):
         help="JSON value of the moves to be created",
     )
     preview_move_data = fields.Text(
-        compute="_compute_preview_move_data",
+        compute="_compute_move_data",
         help="JSON value of the data to be displayed in the previewer",
     )
 
@@ -116,17 +163,17 @@ class AccountInvoiceClearingWizard(models.TransientModel):
     @api.depends("invoice_ids")
     def _compute_initial_data(self):
         """Compute initial data for the wizard."""
-        self.update(
-            {
-                "move_type": False,
-                "commercial_partner_id": False,
-                "company_id": False,
-                "company_currency_id": False,
-                "move_line_ids": False,
-            }
-        )
         for record in self:
             if not record.invoice_ids:
+                record.update(
+                    {
+                        "move_type": False,
+                        "commercial_partner_id": False,
+                        "company_id": False,
+                        "company_currency_id": False,
+                        "move_line_ids": [(5, 0, 0)],
+                    }
+                )
                 continue
             company = self._get_companies(record.invoice_ids)[0]
             record.move_type = self._get_move_types(record.invoice_ids)[0]
@@ -136,45 +183,50 @@ class AccountInvoiceClearingWizard(models.TransientModel):
             record.company_id = company
             record.company_currency_id = company.currency_id
             account_type = self._get_account_type_from_move_type(record.move_type)
-            record.move_line_ids = self.invoice_ids.mapped("line_ids").filtered(
-                lambda ml, acc_type=account_type: not ml.full_reconcile_id
-                and ml.balance
-                and ml.account_id.reconcile
-                and ml.account_id.account_type == acc_type
+            eligible_accounts = self.env["account.account"].search(
+                [
+                    ("reconcile", "=", True),
+                    ("account_type", "=", account_type),
+                    ("company_id", "=", company.id),
+                ]
+            )
+            record.move_line_ids = self.env["account.move.line"].search(
+                [
+                    ("move_id", "in", record.invoice_ids._origin.ids),
+                    ("full_reconcile_id", "=", False),
+                    ("balance", "!=", 0.0),
+                    ("account_id", "in", eligible_accounts.ids),
+                ]
             )
 
     @api.depends("move_line_ids", "line_ids")
     def _compute_move_data(self):
-        """Compute the data to be used by the account.move form view."""
-        self.update({"move_data": "[]"})
-        for record in self:
-            if not record.move_line_ids or not record.line_ids:
-                continue
-            record.move_data = json.dumps(
-                record.with_context(preview=True)._get_move_dict_vals()
-            )
-
-    @api.depends("move_data")
-    def _compute_preview_move_data(self):
-        """Compute the data to be displayed in the previewer."""
+        """Compute the moves data to be used by the account.move form view
+        and the data to be displayed in the previewer."""
         am_model = self.env["account.move"]
+        preview_columns = [
+            {"field": "account_id", "label": _("Account")},
+            {"field": "name", "label": _("Label")},
+            {"field": "partner_id", "label": _("Partner")},
+            {
+                "field": "debit",
+                "label": _("Debit"),
+                "class": "text-right text-nowrap",
+            },
+            {
+                "field": "credit",
+                "label": _("Credit"),
+                "class": "text-right text-nowrap",
+            },
+        ]
         for record in self:
-            preview_columns = [
-                {"field": "account_id", "label": _("Account")},
-                {"field": "name", "label": _("Label")},
-                {"field": "partner_id", "label": _("Partner")},
-                {
-                    "field": "debit",
-                    "label": _("Debit"),
-                    "class": "text-right text-nowrap",
-                },
-                {
-                    "field": "credit",
-                    "label": _("Credit"),
-                    "class": "text-right text-nowrap",
-                },
-            ]
-            move_vals = json.loads(record.move_data)
+            move_vals = []
+            if record.move_line_ids and record.line_ids:
+                move_vals = record.with_context(preview=True)._get_move_dict_vals()
+            # Serialize before building the preview, as _move_dict_to_preview_vals
+            # replaces ids and amounts of move_vals lines by display values
+            record.move_data = json.dumps(move_vals)
+            # Build the preview from the moves data still in memory
             preview_data = []
             for move in move_vals:
                 preview_vals = am_model._move_dict_to_preview_vals(
@@ -242,11 +294,10 @@ class AccountInvoiceClearingWizard(models.TransientModel):
         self.ensure_one()
         # Always inverse sign because move lines has negative residual amounts
         amount_to_clear = -self.amount_to_clear
+        rounding = self.company_currency_id.rounding
         for line in self.line_ids.filtered(lambda line: not line.amount_to_clear):
             cmp_fnc = float.__le__ if line.amount_residual < 0.0 else float.__ge__
-            if float_is_zero(
-                amount_to_clear, precision_rounding=line.company_currency_id.rounding
-            ):
+            if float_is_zero(amount_to_clear, precision_rounding=rounding):
                 line.amount_to_clear = 0.0
             elif cmp_fnc(amount_to_clear, line.amount_residual):
                 line.amount_to_clear = line.amount_residual
@@ -265,13 +316,13 @@ class AccountInvoiceClearingWizard(models.TransientModel):
     def _action_add_lines(self):
         """Add all possible lines."""
         self.ensure_one()
-        existing_move_lines = self.line_ids.mapped("move_line_id")
+        existing_move_line_ids = set(self.line_ids.mapped("move_line_id").ids)
         last_sequence = self.line_ids[-1].sequence if self.line_ids else 0
         new_lines = []
         for move_line in self._get_available_clearing_move_lines(
             self.move_type, self.commercial_partner_id, self.move_line_ids
         ):
-            if move_line in existing_move_lines:
+            if move_line.id in existing_move_line_ids:
                 continue
             new_lines.append(
                 (0, 0, {"move_line_id": move_line.id, "sequence": last_sequence + 1})
@@ -281,6 +332,34 @@ class AccountInvoiceClearingWizard(models.TransientModel):
             self.line_ids = new_lines
         return self.action_reopen_wizard()
 
+    def _set_lines_sequence(self, sorted_lines):
+        """Renumber lines following the given order in a single query."""
+        self.ensure_one()
+        if not sorted_lines:
+            return
+        sorted_lines.flush_recordset(["sequence"])
+        # Keep write_date up to date, transient records are vacuumed on it
+        self.env.cr.execute(
+            """
+            UPDATE account_invoice_clearing_lines_wizard AS line
+            SET sequence = data.sequence,
+                write_date = now() at time zone 'UTC',
+                write_uid = %s
+            FROM unnest(%s, %s) AS data(id, sequence)
+            WHERE line.id = data.id
+            """,
+            (
+                self.env.uid,
+                sorted_lines.ids,
+                list(range(10, 10 + len(sorted_lines))),
+            ),
+        )
+        sorted_lines.invalidate_recordset(["sequence", "write_date", "write_uid"])
+        # Lines order changed: reload them and recompute the moves data, as
+        # the clearing amounts are allocated following that order
+        self.invalidate_recordset(["line_ids"])
+        self.modified(["line_ids"])
+
     def _action_sort_by_date_due(self, reverse=False):
         """Sort lines by date due."""
         self.ensure_one()
@@ -288,8 +367,7 @@ class AccountInvoiceClearingWizard(models.TransientModel):
         sorted_lines = self.line_ids.sorted(
             key=lambda line: line.date_maturity or max_date, reverse=reverse
         )
-        for seq, line in enumerate(sorted_lines, start=10):
-            line.sequence = seq
+        self._set_lines_sequence(sorted_lines)
         return self.action_reopen_wizard()
 
     def action_sort_by_date_due_asc(self):
@@ -306,8 +384,7 @@ class AccountInvoiceClearingWizard(models.TransientModel):
         sorted_lines = self.line_ids.sorted(
             key=lambda line: line.amount_residual, reverse=reverse
         )
-        for seq, line in enumerate(sorted_lines, start=10):
-            line.sequence = seq
+        self._set_lines_sequence(sorted_lines)
         return self.action_reopen_wizard()
 
     def action_sort_by_residual_asc(self):
@@ -324,21 +401,25 @@ class AccountInvoiceClearingWizard(models.TransientModel):
         am_model = self.env["account.move"]
         aml_model = self.env["account.move.line"]
         # Get the fresh resulting moves data
-        res_ids = []
         moves_data = self._get_move_dict_vals()
+        # Extract in order the move_line wich every line needs to be reconciled
+        to_concile_ids = [
+            [line[2].pop("move_line_id_to_reconcile") for line in move_data["line_ids"]]
+            for move_data in moves_data
+        ]
+        all_to_concile_ids = [aml_id for ids in to_concile_ids for aml_id in ids]
+        # Create moves with cleaned data
         for move_data in moves_data:
-            # Extract in order the move_line wich every line needs to be reconciled
-            to_concile_lines = []
-            for move_line in move_data["line_ids"]:
-                to_concile_lines.append(
-                    aml_model.browse(move_line[2]["move_line_id_to_reconcile"])
-                )
-                del move_line[2]["move_line_id_to_reconcile"]
-            # Create move with cleaned data
             del move_data["related_to_move"]
-            move = am_model.create(move_data)
-            move.action_post()
-            res_ids.append(move.id)
+        moves = am_model.create(moves_data)
+        moves.action_post()
+        res_ids = moves.ids
+        for move, move_to_concile_ids in zip(moves, to_concile_ids):
+            to_concile_lines = aml_model.browse(move_to_concile_ids).with_prefetch(
+                all_to_concile_ids
+            )
+            # Reconcile every line with its own counterpart to keep the
+            # allocation computed by the wizard
             for idx, move_line in enumerate(move.line_ids):
                 (move_line | to_concile_lines[idx]).reconcile()
         # Build resulting action
@@ -364,8 +445,7 @@ class AccountInvoiceClearingWizard(models.TransientModel):
     @api.model
     def _get_commercial_partners(self, invoices):
         """Get the commercial partners of the invoices."""
-        partners = invoices.mapped("commercial_partner_id")
-        return partners.mapped("commercial_partner_id")
+        return invoices.mapped("commercial_partner_id")
 
     @api.model
     def _get_companies(self, invoices):
@@ -416,21 +496,13 @@ class AccountInvoiceClearingWizard(models.TransientModel):
         if self.env.context.get("preview"):
             move_name, move_line_prefix = "<Move Name>", "<Move Line Prefix>"
 
+        rounding = self.company_currency_id.rounding
+
         def fiz(amount):
-            return float_is_zero(
-                amount, precision_rounding=self.company_currency_id.rounding
-            )
+            return float_is_zero(amount, precision_rounding=rounding)
 
         def get_debit_credit(amount):
-            if amount > 0.0:
-                return amount, 0.0
-            return 0.0, 0.0 if fiz(amount) else -amount
-
-        def get_amount_to_use(amount_to_fill, avaiable_amount):
-            amount = max(amount_to_fill, avaiable_amount)
-            if amount_to_fill > 0.0:
-                amount = min(amount_to_fill, avaiable_amount)
-            return self.company_currency_id.round(amount)
+            return max(amount, 0.0), 0.0 if fiz(amount) else max(-amount, 0.0)
 
         def build_line_name(move_line):
             txts = [move_line_prefix, move_line.move_id.name, move_line.name]
@@ -438,45 +510,31 @@ class AccountInvoiceClearingWizard(models.TransientModel):
                 txts[1:] = [move_line.move_id.name]
             return " - ".join(list(map(str.strip, filter(lambda t: t, txts))))
 
-        def get_clear_sign_modifier(a, b):
-            different_sign = (a < 0.0 and b > 0.0) or (a > 0.0 and b < 0.0)
-            return -1.0 if different_sign else 1.0
+        # Load all involved move lines and their moves at once, so building
+        # the line vals below only hits the cache
+        all_move_lines = self.move_line_ids | self.line_ids.mapped("move_line_id")
+        all_move_lines.mapped("move_id.name")
 
         clear_lines_availability = OrderedDict()
         for cl in self.line_ids.filtered(lambda line: line.amount_to_clear):
             clear_lines_availability[cl.move_line_id] = cl.amount_to_clear
 
         move_vals = []
+        # Unlike itertools.groupby, odoo.tools.groupby groups all lines of the
+        # same move together, so move lines do not need to be sorted first
         for move, move_lines in groupby(self.move_line_ids, key=lambda ml: ml.move_id):
             line_vals = []
             for move_line in move_lines:
                 related_move_line_vals = []
 
-                ml_amount_residual, cl_balance = move_line.amount_residual, 0.0
-                for cl_move_line in clear_lines_availability:
-                    # Move line fully cleared
-                    if fiz(ml_amount_residual):
-                        break
-                    # Clearing line fully used
-                    if fiz(clear_lines_availability[cl_move_line]):
-                        continue
-
-                    # Choose correct sign to compute clearing amount
-                    clear_sign = get_clear_sign_modifier(
-                        ml_amount_residual, clear_lines_availability[cl_move_line]
-                    )
-
-                    # Used amount for clearing (sign aligned)
-                    used_amount = get_amount_to_use(
-                        ml_amount_residual,
-                        clear_sign * clear_lines_availability[cl_move_line],
-                    )
+                cl_balance = 0.0
+                for cl_move_line, used_amount, clear_sign in _allocate_clearing_amount(
+                    move_line.amount_residual,
+                    clear_lines_availability,
+                    rounding,
+                ):
                     # Clearing balance for this move line
                     cl_balance += clear_sign * used_amount
-                    # Remaining amount to clear on this move
-                    ml_amount_residual -= used_amount
-                    # Remaining amount on this clearing move line
-                    clear_lines_availability[cl_move_line] += used_amount
                     cl_debit, cl_credit = get_debit_credit(used_amount)
                     related_move_line_vals.append(
                         {
@@ -526,7 +584,7 @@ class AccountInvoiceClearingWizard(models.TransientModel):
         """Check that all invoices are from the same
         commercial partner, type and company."""
         for record in self:
-            if len(set(self._get_commercial_partners(record.invoice_ids))) > 1:
+            if len(self._get_commercial_partners(record.invoice_ids)) > 1:
                 raise exceptions.ValidationError(
                     _("Invoices must be from the same commercial partner.")
                 )
@@ -615,11 +673,14 @@ class AccountInvoiceClearingLinesWizard(models.TransientModel):
     @api.depends("amount_residual")
     def _compute_can_use_line(self):
         """Compute if the line can be used for clearing."""
-        self.update({"can_use_line": False})
-        for record in self:
-            if record.clearing_id.amount_to_clear == 0.0:
-                continue
-            record.can_use_line = record.amount_residual != record.amount_to_clear
+        for clearing, records in groupby(self, key=lambda line: line.clearing_id):
+            # Remaining amount to clear is computed once per wizard
+            nothing_to_clear = clearing.amount_to_clear == 0.0
+            for record in records:
+                record.can_use_line = (
+                    not nothing_to_clear
+                    and record.amount_residual != record.amount_to_clear
+                )
 
     # Actions
     def action_use_all_amount_residual(self):